@@ -1,153 +1,327 @@
+import ipaddress
+import json
 import logging
+import os
+import socket
+import struct
 import sys
-import time
+from bisect import bisect_left, bisect_right
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
-from typing import Dict, Iterable, List, Tuple
+from itertools import chain
+from typing import Dict, Iterable, List, Tuple, Union
 
 import requests
-from netaddr import IPNetwork, AddrFormatError, cidr_merge, cidr_exclude
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+IP_ADDRESS_TYPES = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
 
 REGION_ASNS: Dict[str, List[int]] = {
     "SG": [44907, 62014],
     "US": [59930],
     "EU": [62041, 211157],
 }
+ALL_ASNS: List[int] = list(chain.from_iterable(REGION_ASNS.values()))
+# region 名称映射为小整数 ID，去重叠处理的热路径中只比较整数
+REGIONS: List[str] = list(REGION_ASNS)
+REGION_IDS: Dict[str, int] = {region: region_id for region_id, region in enumerate(REGIONS)}
 
 author = "RzMY"
 repo_name = "Telegram-CIDR-Regions"
 base_url = "https://stat.ripe.net/data/announced-prefixes/data.json?resource=AS{asn}"
 max_retries = 3
+retry_status_codes = (429, 500, 502, 503, 504)
 request_timeout = 15
+write_buffer_size = 1 << 20
+max_fetch_workers = 8
+cache_file = os.path.join("cache", "ripe_cache.json")
+user_agent = f"{repo_name} (+https://github.com/{author}/{repo_name})"
+
+
+class LoggingRetry(Retry):
+    def get_backoff_time(self) -> float:
+        # urllib3 默认第一次重试不等待；这里让首次重试也等待 backoff_factor 秒（1s、2s、...）
+        backoff = super().get_backoff_time()
+        if backoff == 0 and self.history:
+            return float(self.backoff_factor)
+        return backoff
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        new_retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        reason = error if error is not None else f"HTTP {response.status}"
+        logging.warning(
+            "Attempt %d for %s failed: %s (retrying in %.1fs)",
+            len(new_retry.history),
+            url,
+            reason,
+            new_retry.get_backoff_time(),
+        )
+        return new_retry
+
+
+def create_session(pool_size: int) -> requests.Session:
+    # 所有 ASN 都请求同一主机，共享连接池以复用 keep-alive 连接
+    # 重试与指数回退交给 urllib3 在连接层处理
+    retries = LoggingRetry(
+        total=max_retries - 1,
+        backoff_factor=1,
+        status_forcelist=retry_status_codes,
+        allowed_methods=frozenset(["GET"]),
+    )
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": user_agent, "Accept-Encoding": "gzip"})
+    return session
+
+
+# 线程数受 I/O 并发限制而非 ASN 数量，连接池与之对齐，避免线程争抢连接
+fetch_workers = min(len(ALL_ASNS), max_fetch_workers)
+SESSION = create_session(fetch_workers)
 
 
 def setup_logging() -> None:
+    level_name = (os.environ.get("LOG_LEVEL") or "INFO").upper()
+    level = logging.getLevelName(level_name)
     logging.basicConfig(
-        level=logging.INFO,
+        level=level if isinstance(level, int) else logging.INFO,
         format="%(asctime)s [%(levelname)s] %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
+    if not isinstance(level, int):
+        logging.warning("Unknown LOG_LEVEL %s, falling back to INFO", level_name)
+
+
+def load_cache() -> Dict[str, Dict]:
+    try:
+        with open(cache_file, "rb") as fp:
+            cache = json_loads(fp.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exc:
+        logging.warning("Ignore unreadable cache %s: %s", cache_file, exc)
+        return {}
+    if not isinstance(cache, dict):
+        logging.warning("Ignore malformed cache %s: expected an object, got %s", cache_file, type(cache).__name__)
+        return {}
+    return cache
 
 
-def fetch_prefixes(asn: int) -> List[str]:
+def save_cache(cache: Dict[str, Dict]) -> None:
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, "w", encoding="utf-8") as fp:
+        json.dump(cache, fp)
+
+
+def fetch_prefixes(asn: int, cache: Dict[str, Dict]) -> List[str]:
     url = base_url.format(asn=asn)
-    for attempt in range(1, max_retries + 1):
-        try:
-            response = requests.get(url, timeout=request_timeout)
-            response.raise_for_status()
-            data = response.json()
-            prefixes = data.get("data", {}).get("prefixes", [])
-            extracted = [p.get("prefix") for p in prefixes if p.get("prefix")]
-            logging.info("ASN %s fetched %d prefixes: %s", asn, len(extracted), extracted)
-            return extracted
-        except (requests.RequestException, ValueError) as exc:
-            wait_seconds = 2 ** (attempt - 1)
-            logging.warning(
-                "Attempt %d for ASN %s failed: %s (retrying in %ds)",
-                attempt,
-                asn,
-                exc,
-                wait_seconds,
-            )
-            if attempt < max_retries:
-                time.sleep(wait_seconds)
-    logging.error("Failed to fetch prefixes for ASN %s after %d attempts", asn, max_retries)
-    return []
+    # 携带上次的 ETag / Last-Modified 发起条件请求，数据未变化时直接复用缓存
+    cached = cache.get(str(asn))
+    if not isinstance(cached, dict) or not isinstance(cached.get("prefixes"), list):
+        cached = None
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        response = SESSION.get(url, headers=headers, timeout=request_timeout)
+        response.raise_for_status()
+        if response.status_code == 304 and cached:
+            logging.info("ASN %s not modified, using %d cached prefixes", asn, len(cached["prefixes"]))
+            return cached["prefixes"]
+        data = json_loads(response.content)
+    except (requests.RequestException, ValueError) as exc:
+        logging.error("Failed to fetch prefixes for ASN %s (max %d attempts): %s", asn, max_retries, exc)
+        if cached:
+            # 临时故障时沿用磁盘缓存，避免该 ASN 的网段从生成的列表中消失
+            logging.warning("ASN %s falling back to %d cached prefixes", asn, len(cached["prefixes"]))
+            return cached["prefixes"]
+        return []
+    prefixes = data.get("data", {}).get("prefixes", [])
+    extracted = [p.get("prefix") for p in prefixes if p.get("prefix")]
+    logging.info("ASN %s fetched %d prefixes", asn, len(extracted))
+    logging.debug("ASN %s prefixes: %s", asn, extracted)
+    cache[str(asn)] = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "prefixes": extracted,
+    }
+    return extracted
 
 
 def gather_prefixes() -> Dict[str, List[str]]:
     region_prefixes: Dict[str, List[str]] = {region: [] for region in REGION_ASNS}
     asn_futures = {}
-    with ThreadPoolExecutor(max_workers=len(sum(REGION_ASNS.values(), []))) as executor:
+    cache = load_cache()
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
         for region, asns in REGION_ASNS.items():
             for asn in asns:
-                future = executor.submit(fetch_prefixes, asn)
-                asn_futures[future] = (region, asn)
+                future = executor.submit(fetch_prefixes, asn, cache)
+                asn_futures[future] = (REGION_IDS[region], asn)
         
         # 收集所有前缀及其对应的 region 和 ASN
-        all_networks: List[Tuple[IPNetwork, str, int]] = []  # (network, region, asn)
+        all_networks: List[Tuple[IPNetwork, int, int]] = []  # (network, region_id, asn)
+        seen_networks = set()  # (network, region_id)，同一 region 内的重复网段只保留一次
         
         for future in as_completed(asn_futures):
-            region, asn = asn_futures[future]
+            region_id, asn = asn_futures[future]
             try:
                 result = future.result()
-                for prefix in result:
+                for prefix in dict.fromkeys(result):
                     try:
-                        network = IPNetwork(prefix)
-                        all_networks.append((network, region, asn))
-                    except (AddrFormatError, ValueError) as exc:
+                        network = ipaddress.ip_network(prefix, strict=False)
+                        if (network, region_id) not in seen_networks:
+                            seen_networks.add((network, region_id))
+                            all_networks.append((network, region_id, asn))
+                    except ValueError as exc:
                         logging.warning("Invalid prefix %s from ASN %s: %s", prefix, asn, exc)
             except Exception as exc:  # noqa: BLE001
-                logging.error("Unhandled exception when fetching for region %s: %s", region, exc)
-        
-        # 按 prefix length 降序排序（更具体的优先）
-        all_networks.sort(key=lambda x: (x[0].version, -x[0].prefixlen, int(x[0].network)))
+                logging.error("Unhandled exception when fetching for region %s: %s", REGIONS[region_id], exc)
+    save_cache(cache)
+    
+    # 拉取完成后即释放线程池，去重叠处理为纯 CPU 计算，无需占用工作线程
+    # 按 prefix length 降序排序（更具体的优先）
+    all_networks.sort(key=lambda x: (x[0].version, -x[0].prefixlen, int(x[0].network_address)))
+    
+    # 去除重叠：保留更具体的网段，拆分重叠的更大网段
+    final_networks: List[Tuple[IPNetwork, int, int]] = []
+    # 按 IP 版本维护已添加网段的起始地址有序索引；已添加的网段都不比当前网段大，
+    # 因此起始地址落在当前网段范围内的条目必然被当前网段包含。
+    # 条目同时保存整数地址范围 (first, last)，包含判断只需两次整数比较
+    final_index: Dict[int, Tuple[List[int], List[Tuple[int, int, IPNetwork, int, int]]]] = {4: ([], []), 6: ([], [])}
+
+    def add_final(network: IPNetwork, region_id: int, asn: int) -> None:
+        final_networks.append((network, region_id, asn))
+        starts, entries = final_index[network.version]
+        first = int(network.network_address)
+        pos = bisect_right(starts, first)
+        starts.insert(pos, first)
+        entries.insert(pos, (first, int(network.broadcast_address), network, region_id, asn))
+
+    split_counts: List[int] = [0] * len(REGIONS)
+    log_splits = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for network, region_id, asn in all_networks:
+        # 检查与已添加的更具体网段的重叠情况（network 更大，existing 更具体）
+        starts, entries = final_index[network.version]
+        network_first = int(network.network_address)
+        network_last = int(network.broadcast_address)
+        lo = bisect_left(starts, network_first)
+        hi = bisect_right(starts, network_last)
+        overlapping_nets = [entry for entry in entries[lo:hi] if entry[3] != region_id]
         
-        # 去除重叠：保留更具体的网段，拆分重叠的更大网段
-        final_networks: List[Tuple[IPNetwork, str, int]] = []
-        for network, region, asn in all_networks:
-            # 检查与已添加的更具体网段的重叠情况
-            overlapping_nets = []
-            for existing_net, existing_region, existing_asn in final_networks:
-                if network.version == existing_net.version:
-                    # 检查 existing_net 是否被 network 包含（network 更大，existing 更具体）
-                    if existing_net in network and existing_region != region:
-                        overlapping_nets.append((existing_net, existing_region, existing_asn))
-            
-            if overlapping_nets:
-                # 从当前网段中排除所有已添加的更具体网段
-                remaining_nets = [network]
-                for overlap_net, overlap_region, overlap_asn in overlapping_nets:
-                    new_remaining = []
-                    for remain_net in remaining_nets:
-                        if overlap_net in remain_net:
-                            # 排除重叠部分
-                            excluded = cidr_exclude(remain_net, overlap_net)
-                            new_remaining.extend(excluded)
-                            logging.info(
-                                "Split %s/%d from %s (ASN %s): exclude %s/%d from %s (ASN %s), remaining: %s",
-                                remain_net.network, remain_net.prefixlen, region, asn,
-                                overlap_net.network, overlap_net.prefixlen, overlap_region, overlap_asn,
+        if overlapping_nets:
+            # 从当前网段中排除所有已添加的更具体网段
+            # 剩余网段放在同一个 deque 中轮转处理：每轮只取出本轮开始时已有的条目，
+            # 处理结果追加到队尾，避免每轮重建列表
+            remaining_nets = deque([(network_first, network_last, network)])
+            for overlap_first, overlap_last, overlap_net, overlap_region_id, overlap_asn in overlapping_nets:
+                for _ in range(len(remaining_nets)):
+                    remain_first, remain_last, remain_net = remaining_nets.popleft()
+                    if remain_first <= overlap_first and overlap_last <= remain_last:
+                        # 排除重叠部分
+                        excluded = sorted(remain_net.address_exclude(overlap_net))
+                        remaining_nets.extend(
+                            (int(n.network_address), int(n.broadcast_address), n) for n in excluded
+                        )
+                        split_counts[region_id] += 1
+                        if log_splits:
+                            logging.debug(
+                                "Split %s from %s (ASN %s): exclude %s from %s (ASN %s), remaining: %s",
+                                remain_net, REGIONS[region_id], asn,
+                                overlap_net, REGIONS[overlap_region_id], overlap_asn,
                                 [str(n) for n in excluded]
                             )
-                        else:
-                            new_remaining.append(remain_net)
-                    remaining_nets = new_remaining
-                
-                # 将拆分后的剩余网段添加到结果中
-                for remain_net in remaining_nets:
-                    final_networks.append((remain_net, region, asn))
-            else:
-                # 没有重叠，直接添加
-                final_networks.append((network, region, asn))
-        
-        # 分配到各 region
-        for network, region, _ in final_networks:
-            region_prefixes[region].append(str(network))
+                    elif not (overlap_first <= remain_first and remain_last <= overlap_last):
+                        remaining_nets.append((remain_first, remain_last, remain_net))
+            
+            # 将拆分后的剩余网段添加到结果中
+            for _, _, remain_net in remaining_nets:
+                add_final(remain_net, region_id, asn)
+        else:
+            # 没有重叠，直接添加
+            add_final(network, region_id, asn)
+    
+    for region, split_count in zip(REGIONS, split_counts):
+        logging.info("Region %s: %d splits applied", region, split_count)
+    
+    # 分配到各 region
+    for network, region_id, _ in final_networks:
+        region_prefixes[REGIONS[region_id]].append(str(network))
     
     return region_prefixes
 
 
+def merge_ranges(ranges: List[Tuple[int, int]], version: int) -> List[IPNetwork]:
+    # 按起始地址排序后线性合并重叠/相邻区间，最后才转换回 CIDR
+    ranges.sort()
+    merged: List[List[int]] = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1][1] = last
+        else:
+            merged.append([first, last])
+    address_type = IP_ADDRESS_TYPES[version]
+    networks: List[IPNetwork] = []
+    for first, last in merged:
+        networks.extend(ipaddress.summarize_address_range(address_type(first), address_type(last)))
+    return networks
+
+
+def prefix_to_range(prefix: str) -> Tuple[bool, int, int]:
+    # 直接用 inet_pton 把地址转换为整数，省去构造网段对象；主机位按非严格模式清零
+    addr, sep, plen = prefix.partition("/")
+    if sep and not (plen.isascii() and plen.isdigit()):
+        raise ValueError(f"invalid prefix length {plen!r}")
+    is_v6 = ":" in addr
+    if is_v6:
+        ip_int = int.from_bytes(socket.inet_pton(socket.AF_INET6, addr), "big")
+        bits = 128
+    else:
+        ip_int = struct.unpack("!I", socket.inet_pton(socket.AF_INET, addr))[0]
+        bits = 32
+    prefixlen = int(plen) if sep else bits
+    if not 0 <= prefixlen <= bits:
+        raise ValueError(f"prefix length {prefixlen} out of range")
+    host_mask = (1 << (bits - prefixlen)) - 1
+    first = ip_int & ~host_mask
+    return is_v6, first, first | host_mask
+
+
 def split_and_merge(prefixes: Iterable[str]) -> Tuple[List[IPNetwork], List[IPNetwork]]:
-    v4_networks: List[IPNetwork] = []
-    v6_networks: List[IPNetwork] = []
-    for prefix in prefixes:
+    v4_ranges: List[Tuple[int, int]] = []
+    v6_ranges: List[Tuple[int, int]] = []
+    # 先按原始字符串去重，避免重复解析
+    for prefix in dict.fromkeys(prefixes):
         try:
-            network = IPNetwork(prefix)
-        except (AddrFormatError, ValueError) as exc:
+            is_v6, first, last = prefix_to_range(prefix)
+        except (OSError, ValueError) as exc:
             logging.warning("Skip invalid prefix %s: %s", prefix, exc)
             continue
-        if network.version == 4:
-            v4_networks.append(network)
-        elif network.version == 6:
-            v6_networks.append(network)
-    merged_v4 = cidr_merge(v4_networks)
-    merged_v6 = cidr_merge(v6_networks)
+        ranges = v6_ranges if is_v6 else v4_ranges
+        ranges.append((first, last))
+    merged_v4 = merge_ranges(v4_ranges, 4)
+    merged_v6 = merge_ranges(v6_ranges, 6)
     return merged_v4, merged_v6
 
 
 def sort_networks(networks: Iterable[IPNetwork]) -> List[IPNetwork]:
-    return sorted(networks, key=lambda n: (n.version, int(n.network)))
+    # 先计算一次排序键再排序，避免比较过程中重复访问属性
+    decorated = [(n.version, int(n.network_address), n) for n in networks]
+    decorated.sort()
+    return [n for _, _, n in decorated]
 
 
 def build_header(region: str, v4_count: int, v6_count: int) -> List[str]:
@@ -168,13 +342,13 @@ def write_region_file(region: str, v4_networks: List[IPNetwork], v6_networks: Li
     file_name = f"Telegram{region}.list"
     v4_sorted = sort_networks(v4_networks)
     v6_sorted = sort_networks(v6_networks)
-    lines = build_header(region, len(v4_sorted), len(v6_sorted))
-    for net in v4_sorted:
-        lines.append(f"IP-CIDR,{net},Telegram{region}")
-    for net in v6_sorted:
-        lines.append(f"IP6-CIDR,{net},Telegram{region}")
-    with open(file_name, "w", encoding="utf-8") as fp:
-        fp.write("\n".join(lines) + "\n")
+    header = build_header(region, len(v4_sorted), len(v6_sorted))
+    suffix = f",Telegram{region}\n".encode("utf-8")
+    # 以二进制缓冲写入预编码的行，避免文本模式的逐行编码与中间大字符串
+    with open(file_name, "wb", buffering=write_buffer_size) as fp:
+        fp.write(("\n".join(header) + "\n").encode("utf-8"))
+        fp.writelines(b"IP-CIDR," + str(net).encode("ascii") + suffix for net in v4_sorted)
+        fp.writelines(b"IP6-CIDR," + str(net).encode("ascii") + suffix for net in v6_sorted)
     logging.info(
         "Wrote %s with %d IPv4 and %d IPv6 prefixes after merge",
         file_name,
@@ -183,18 +357,23 @@ def write_region_file(region: str, v4_networks: List[IPNetwork], v6_networks: Li
     )
 
 
+def process_region(region: str, prefixes: List[str]) -> None:
+    logging.info(
+        "Processing region %s with %d prefixes (merging within region only)",
+        region,
+        len(prefixes),
+    )
+    v4_networks, v6_networks = split_and_merge(prefixes)
+    write_region_file(region, v4_networks, v6_networks)
+
+
 def main() -> int:
     setup_logging()
     logging.info("Starting Telegram CIDR update")
     prefix_map = gather_prefixes()
-    for region, prefixes in prefix_map.items():
-        logging.info(
-            "Processing region %s with %d prefixes (merging within region only)",
-            region,
-            len(prefixes),
-        )
-        v4_networks, v6_networks = split_and_merge(prefixes)
-        write_region_file(region, v4_networks, v6_networks)
+    # 各 region 的合并与写文件互不依赖，并行处理以重叠文件写入与下一个 region 的计算
+    with ThreadPoolExecutor(max_workers=len(prefix_map)) as executor:
+        list(executor.map(process_region, prefix_map.keys(), prefix_map.values()))
     logging.info("All region files generated")
     return 0
 